@@ -37,56 +37,168 @@ _REQ_TYPE_CLASS = const(0x20)
 _MP_BLOCKDEV_IOCTL_BLOCK_COUNT = const(4)
 
 _MSC_REQ_GET_GET_MAX_LUN = const(254)
+# Reply buffer for GET MAX LUN shared by all devices so enumeration doesn't allocate it.
+_max_lun_buffer = bytearray(1)
+
+# Largest number of blocks moved by a single READ (10) or WRITE (10) command.
+_MAX_SECTORS_PER_CBW = const(128)
+_MAX_BYTES_PER_CBW = const(_MAX_SECTORS_PER_CBW * 512)
 
 # SCSI commands
+# The SCSI Test Unit Ready command is used to determine if a device is ready to transfer data
+# (read/write), i.e. if a disk has spun up, if a tape is loaded and ready etc. The device does
+# not perform a self-test operation.
 _SCSI_CMD_TEST_UNIT_READY = const(0x00)
-"""The SCSI Test Unit Ready command is used to determine if a device is ready to transfer data
-(read/write), i.e. if a disk has spun up, if a tape is loaded and ready etc. The device does not
-perform a self-test operation."""
+# The SCSI Inquiry command is used to obtain basic information from a target device.
 _SCSI_CMD_INQUIRY = const(0x12)
-"""The SCSI Inquiry command is used to obtain basic information from a target device."""
+# The SCSI Read Capacity command is used to obtain data capacity information from a target
+# device.
 _SCSI_CMD_READ_CAPACITY_10 = const(0x25)
-"""The SCSI Read Capacity command is used to obtain data capacity information from a target
-device."""
+# The SCSI Request Sense command is part of the SCSI computer protocol standard. This command
+# is used to obtain sense data -- status/error information -- from a target device.
 _SCSI_CMD_REQUEST_SENSE = const(0x03)
-"""The SCSI Request Sense command is part of the SCSI computer protocol standard. This command is
-used to obtain sense data -- status/error information -- from a target device."""
+# The READ (10) command requests that the device server read the specified logical block(s)
+# and transfer them to the data-in buffer.
 _SCSI_CMD_READ_10 = const(0x28)
-"""The READ (10) command requests that the device server read the specified logical block(s) and
-transfer them to the data-in buffer."""
+# The WRITE (10) command requests that the device server transfer the specified logical
+# block(s) from the data-out buffer and write them.
 _SCSI_CMD_WRITE_10 = const(0x2A)
-"""The WRITE (10) command requests that the device server transfer the specified logical block(s)
-from the data-out buffer and write them."""
 
 
-class USBMassStorage:
-    """CircuitPython BlockDevice backed by a USB mass storage device (aka thumb drive)."""
+def _import_asyncio():
+    """Import asyncio on first use so code that only reads and writes synchronously
+    doesn't pay for it."""
+    try:
+        import asyncio  # pylint: disable=import-outside-toplevel
+    except ImportError as error:
+        raise ImportError(
+            "The async methods need asyncio. Install adafruit-circuitpython-asyncio."
+        ) from error
+    return asyncio
+
+
+class USBMassStorage:  # pylint: disable=too-many-instance-attributes
+    """CircuitPython BlockDevice backed by a USB mass storage device (aka thumb drive).
+
+    On boards with PSRAM, buffers passed to `readblocks` and `writeblocks` should be
+    allocated early so they are in internal RAM. USB transfers from PSRAM may need an
+    extra copy.
+
+    By default the constructor blocks until the device is ready. Pass ``wait=False``
+    and then ``await`` `await_ready` to let other tasks run while a drive spins up."""
+
+    # (in_ep, out_ep, in_packet_size, msc_interface, config_value) keyed by (VID, PID)
+    _endpoint_cache = {}
+
+    def __init__(self, device: usb.core.Device, lun=0, wait=True):
+        self.lun = lun
+        # Allocate the transfer buffers first. On boards with PSRAM this makes
+        # it more likely they land in internal RAM that USB DMA can reach.
+        # SCSI command block
+        self.cbw = bytearray(31)
+        self.cbw[0:4] = b"\x55\x53\x42\x43"
+        self.cbw[13] = self.lun
+        self._cbw_view = memoryview(self.cbw)
+        # Prebuilt READ (10) and WRITE (10) command blocks. Only the block number,
+        # and the length and block count when they change, are updated per call.
+        self._read_cbw = self._block_cbw(_DIR_IN, _SCSI_CMD_READ_10)
+        self._write_cbw = self._block_cbw(_DIR_OUT, _SCSI_CMD_WRITE_10)
+        # Prebuilt TEST UNIT READY command block. It has no data phase and is
+        # sent repeatedly while waiting for the device.
+        self._test_ready_cbw = bytearray(self.cbw)
+        self._test_ready_cbw[14] = 6
+        self._test_ready_cbw[15] = _SCSI_CMD_TEST_UNIT_READY
+        self._test_ready_cbw[16] = self.lun
+        # SCSI command status
+        self.csw = bytearray(13)
+        self.csw[0:4] = b"\x55\x53\x42\x53"
+        # Low byte of the tag sent in the last CBW. The device echoes it in the CSW.
+        self._tag = 0
+        # Reused 6 byte SCSI command and sense buffers for INQUIRY and ready polling.
+        self._cmd6 = bytearray(6)
+        self._sense_resp = bytearray(14)
+
+        self.sector_count = None
+        self.block_size = None
+
+        self.device = device
+        # Reuse the endpoints found for an earlier device with the same VID and PID.
+        key = (device.idVendor, device.idProduct)
+        endpoints = USBMassStorage._endpoint_cache.get(key)
+        if endpoints:
+            try:
+                self._configure(endpoints)
+            except (usb.core.USBError, RuntimeError):
+                # A different drive can share the VID and PID. Look again once.
+                del USBMassStorage._endpoint_cache[key]
+                endpoints = None
+        if not endpoints:
+            endpoints = self._find_msc_endpoints(device)
+            self._configure(endpoints)
+            USBMassStorage._endpoint_cache[key] = endpoints
+
+        if wait:
+            self._wait_for_ready()
+
+    def _configure(self, endpoints) -> None:
+        """Select the configuration with the mass storage interface and check it
+        answers INQUIRY."""
+        (
+            self.in_ep,
+            self.out_ep,
+            self._in_packet_size,
+            msc_interface,
+            config_value,
+        ) = endpoints
+        self.device.set_configuration(config_value)
+
+        # Get the max lun. Only the request matters; the reply isn't used.
+        try:
+            self.device.ctrl_transfer(
+                _REQ_RCPT_INTERFACE | _REQ_TYPE_CLASS | _DIR_IN,
+                _MSC_REQ_GET_GET_MAX_LUN,
+                0,
+                msc_interface,
+                _max_lun_buffer,
+            )
+        except usb.core.USBError:
+            # Stall means 0.
+            pass
+
+        self._inquire()
 
-    def __init__(self, device: usb.core.Device, lun=0):
+    @staticmethod
+    def _find_msc_endpoints(device):  # pylint: disable=too-many-locals
+        """Find the mass storage interface and endpoints of the first configuration."""
         config_descriptor = adafruit_usb_host_descriptors.get_configuration_descriptor(
             device, 0
         )
 
-        self.in_ep = 0
-        self.out_ep = 0
+        in_ep = 0
+        out_ep = 0
+        in_packet_size = 64
 
-        self.sector_count = None
-        self.block_size = None
         # Look over each descriptor for mass storage interface and then the two
         # endpoints.
         in_msc_interface = False
         msc_interface = None
         i = 0
         config_value = 0
-        while i < len(config_descriptor):
+        config_len = len(config_descriptor)
+        while i < config_len:
             descriptor_len = config_descriptor[i]
+            # A zero length descriptor is malformed and would never advance.
+            if descriptor_len == 0:
+                break
             descriptor_type = config_descriptor[i + 1]
             if descriptor_type == adafruit_usb_host_descriptors.DESC_CONFIGURATION:
                 config_value = config_descriptor[i + 5]
             elif descriptor_type == adafruit_usb_host_descriptors.DESC_INTERFACE:
-                interface_number = config_descriptor[i + 2]
-                interface_class = config_descriptor[i + 5]
-                interface_subclass = config_descriptor[i + 6]
+                (
+                    interface_number,
+                    interface_class,
+                    interface_subclass,
+                ) = struct.unpack_from("<BxxBB", config_descriptor, i + 2)
                 in_msc_interface = interface_class == 8 and interface_subclass == 6
                 if in_msc_interface:
                     msc_interface = interface_number
@@ -94,91 +206,137 @@ class USBMassStorage:
                 descriptor_type == adafruit_usb_host_descriptors.DESC_ENDPOINT
                 and in_msc_interface
             ):
-                endpoint_address = config_descriptor[i + 2]
+                endpoint_address, packet_size = struct.unpack_from(
+                    "<BxH", config_descriptor, i + 2
+                )
                 if endpoint_address & _DIR_IN:
-                    self.in_ep = endpoint_address
+                    in_ep = endpoint_address
+                    # A malformed size of 0 would break short packet detection.
+                    in_packet_size = packet_size or 64
                 else:
-                    self.out_ep = endpoint_address
+                    out_ep = endpoint_address
             i += descriptor_len
 
-        if self.in_ep == 0 or self.out_ep == 0:
+        if in_ep == 0 or out_ep == 0:
             raise ValueError("No MSC interface found")
+        return in_ep, out_ep, in_packet_size, msc_interface, config_value
 
-        self.lun = lun
-        self.device = device
-        self.device.set_configuration(config_value)
-
-        # Get the max lun.
-        max_lun = bytearray(1)
-        try:
-            device.ctrl_transfer(
-                _REQ_RCPT_INTERFACE | _REQ_TYPE_CLASS | _DIR_IN,
-                _MSC_REQ_GET_GET_MAX_LUN,
-                0,
-                msc_interface,
-                max_lun,
-            )
-            max_lun = max_lun[0] + 1
-        except usb.core.USBError:
-            # Stall means 0.
-            max_lun = 0
-
-        # SCSI command block
-        self.cbw = bytearray(31)
-        self.cbw[0:4] = b"\x55\x53\x42\x43"
-        self.cbw[14] = self.lun
-        # SCSI command status
-        self.csw = bytearray(13)
-        self.csw[0:4] = b"\x55\x53\x42\x53"
-
-        self._inquire()
-
-        self._wait_for_ready()
+    def _block_cbw(self, direction, opcode) -> bytearray:
+        """Make a READ (10) or WRITE (10) command block from the base CBW"""
+        cbw = bytearray(self.cbw)
+        struct.pack_into("<BBBBB", cbw, 12, direction, self.lun, 10, opcode, self.lun)
+        return cbw
 
     def _scsi_command(self, direction, command, data) -> None:
         """Do a SCSI command over USB. Reads or writes to data depending on direction."""
-        struct.pack_into("<IBxB", self.cbw, 8, len(data), direction, len(command))
-        self.cbw[15 : 15 + len(command)] = command
-        # Write out the command.
-        self.device.write(self.out_ep, self.cbw)
-        # Depending on the direction, read or write the data.
-        if data:
-            if direction == _DIR_IN:
-                self.device.read(self.in_ep, data)
-            else:
-                self.device.write(self.out_ep, data)
-
-        # Get the status.
+        struct.pack_into(
+            "<IBBB", self.cbw, 8, len(data), direction, self.lun, len(command)
+        )
+        self._cbw_view[15 : 15 + len(command)] = command
+        if not data:
+            self._scsi_nodata(self.cbw)
+        elif direction == _DIR_IN:
+            self._scsi_in(self.cbw, data)
+        else:
+            self._scsi_out(self.cbw, data)
+
+    def _send_cbw(self, cbw) -> None:
+        """Tag cbw with the next command number and send it."""
+        self._tag = (self._tag + 1) & 0xFF
+        cbw[4] = self._tag
+        self.device.write(self.out_ep, cbw)
+
+    def _read_csw(self) -> None:
+        """Read the command status and check it answers the last command sent."""
         self.device.read(self.in_ep, self.csw)
+        if self.csw[4] != self._tag:
+            raise RuntimeError("Command status tag mismatch")
+
+    def _scsi_in(self, cbw, data) -> None:
+        """Send cbw, read the data phase into data and then read the status."""
+        self._send_cbw(cbw)
+        count = self.device.read(self.in_ep, data)
+        # Only a partial transfer of whole packets continues. A short packet ends
+        # the data phase early.
+        if 0 < count < len(data) and not count % self._in_packet_size:
+            view = memoryview(data)[count:]
+            while view:
+                count = self.device.read(self.in_ep, view)
+                if not count or count % self._in_packet_size:
+                    break
+                view = view[count:]
+        self._read_csw()
+
+    def _scsi_out(self, cbw, data) -> None:
+        """Send cbw, write data as the data phase and then read the status."""
+        self._send_cbw(cbw)
+        count = self.device.write(self.out_ep, data)
+        if 0 < count < len(data):
+            view = memoryview(data)[count:]
+            while view:
+                count = self.device.write(self.out_ep, view)
+                if not count:
+                    break
+                view = view[count:]
+        self._read_csw()
+
+    def _scsi_nodata(self, cbw) -> None:
+        """Send cbw and read its status straight after."""
+        self._send_cbw(cbw)
+        self._read_csw()
 
     def _wait_for_ready(self, tries=100):
         """Waits for the device to be ready."""
-        status = 12
-        self.csw[status] = 1
-        test_ready = bytearray(6)
-        test_ready[0] = _SCSI_CMD_TEST_UNIT_READY
-        test_ready[1] = self.lun
-
-        sense_response = bytearray(18)
-        sense = bytearray(6)
-        sense[0] = _SCSI_CMD_REQUEST_SENSE
-        sense[4] = len(sense_response)
         try_num = 0
-        self._scsi_command(_DIR_OUT, test_ready, b"")
-        while self.csw[status] != 0 and try_num < tries:
+        delay = self._check_ready(try_num, tries)
+        while delay:
+            time.sleep(delay)
             try_num += 1
-            time.sleep(0.1)
-            self._scsi_command(_DIR_IN, sense, sense_response)
-            self._scsi_command(_DIR_OUT, test_ready, b"")
+            delay = self._check_ready(try_num, tries)
 
-        if self.csw[status] != 0:
+    async def await_ready(self, tries=100):
+        """Waits for the device to be ready while letting other tasks run. Use after
+        creating the object with ``wait=False``."""
+        asyncio = _import_asyncio()
+        try_num = 0
+        delay = self._check_ready(try_num, tries)
+        while delay:
+            await asyncio.sleep(delay)
+            try_num += 1
+            delay = self._check_ready(try_num, tries)
+
+    def _check_ready(self, try_num, tries) -> float:
+        """Test whether the device is ready. Returns 0 once it is, otherwise how long
+        to wait before the next try."""
+        self._test_unit_ready()
+        if self.csw[12] == 0:
+            return 0
+        if try_num >= tries:
             raise RuntimeError("Out of tries")
+        if not try_num:
+            self._request_sense()
+        # Most devices are ready quickly so start polling fast and back off.
+        return min(0.001 * (1 << min(try_num, 7)), 0.1)
+
+    def _request_sense(self) -> None:
+        """Clear the last error, such as a unit attention, with REQUEST SENSE.
+        Only the fixed format header is read since the data isn't used."""
+        command = self._cmd6
+        command[0] = _SCSI_CMD_REQUEST_SENSE
+        command[1] = 0
+        command[4] = len(self._sense_resp)
+        self._scsi_command(_DIR_IN, command, self._sense_resp)
+
+    def _test_unit_ready(self) -> None:
+        """Send TEST UNIT READY"""
+        self._scsi_nodata(self._test_ready_cbw)
 
     def _inquire(self) -> None:
         """Run inquiry command"""
         response = bytearray(36)
-        command = bytearray(6)
+        command = self._cmd6
         command[0] = _SCSI_CMD_INQUIRY
+        command[1] = 0
         command[4] = len(response)
         self._scsi_command(_DIR_IN, command, response)
 
@@ -195,35 +353,95 @@ class USBMassStorage:
             1  # Response has the last valid number. Count is one greater.
         )
 
-    def readblocks(self, block_num: int, buf: bytearray) -> None:
-        """Read data from block_num into buf"""
-        command = bytearray(10)
-        struct.pack_into(
-            ">BBIxH",
-            command,
-            0,
-            _SCSI_CMD_READ_10,
-            self.lun,
-            block_num,
-            len(buf) // 512,
+    def readblocks(
+        self, block_num: int, buf: bytearray, *, buf_offset: int = 0
+    ) -> None:
+        """Read data from block_num into buf
+
+        Each command has its own command and status transfers so reading many
+        blocks in one call is much faster than reading them one at a time.
+        buf_offset starts the read that many bytes into buf so one large buffer
+        can be filled a piece at a time."""
+        self._transfer_blocks(self._read_cbw, self._scsi_in, block_num, buf, buf_offset)
+
+    def writeblocks(
+        self, block_num: int, buf: bytearray, *, buf_offset: int = 0
+    ) -> None:
+        """Write data to block_num from buf
+
+        Each command has its own command and status transfers so writing many
+        blocks in one call is much faster than writing them one at a time.
+        buf_offset starts the write that many bytes into buf."""
+        self._transfer_blocks(
+            self._write_cbw, self._scsi_out, block_num, buf, buf_offset
         )
 
-        self._scsi_command(_DIR_IN, command, buf)
+    async def areadblocks(
+        self, block_num: int, buf: bytearray, *, buf_offset: int = 0
+    ) -> None:
+        """Read data from block_num into buf, starting buf_offset bytes into buf and
+        letting other tasks run between commands"""
+        await self._atransfer_blocks(
+            self._read_cbw, self._scsi_in, block_num, buf, buf_offset
+        )
 
-    def writeblocks(self, block_num: int, buf: bytearray) -> None:
-        """Write data to block_num from buf"""
-        command = bytearray(10)
-        struct.pack_into(
-            ">BBIxH",
-            command,
-            0,
-            _SCSI_CMD_WRITE_10,
-            self.lun,
-            block_num,
-            len(buf) // 512,
+    async def awriteblocks(
+        self, block_num: int, buf: bytearray, *, buf_offset: int = 0
+    ) -> None:
+        """Write data to block_num from buf, starting buf_offset bytes into buf and
+        letting other tasks run between commands"""
+        await self._atransfer_blocks(
+            self._write_cbw, self._scsi_out, block_num, buf, buf_offset
         )
 
-        self._scsi_command(_DIR_OUT, command, buf)
+    def _transfer_blocks(  # pylint: disable=too-many-arguments
+        self, cbw, transfer, block_num, buf, offset
+    ) -> None:
+        """Move buf to or from the device using as few commands as possible."""
+        view = self._block_view(buf, offset)
+        while offset < len(view):
+            size = self._transfer_chunk(cbw, transfer, block_num, view, offset)
+            block_num += size >> 9
+            offset += size
+
+    async def _atransfer_blocks(  # pylint: disable=too-many-arguments
+        self, cbw, transfer, block_num, buf, offset
+    ) -> None:
+        """Async version of _transfer_blocks. Each USB transfer still blocks."""
+        asyncio = _import_asyncio()
+        view = self._block_view(buf, offset)
+        while offset < len(view):
+            size = self._transfer_chunk(cbw, transfer, block_num, view, offset)
+            block_num += size >> 9
+            offset += size
+            await asyncio.sleep(0)
+
+    @staticmethod
+    def _block_view(buf, offset):
+        """Check buf holds whole blocks after offset and return what to slice
+        commands from. A whole buffer that fits in one command is used as is."""
+        if offset and not 0 < offset < len(buf):
+            raise ValueError("buf_offset must be inside buf")
+        if (len(buf) - offset) & 511:
+            raise ValueError("Buffer length must be a multiple of 512")
+        if not offset and len(buf) <= _MAX_BYTES_PER_CBW:
+            return buf
+        return memoryview(buf)
+
+    @staticmethod
+    def _transfer_chunk(cbw, transfer, block_num, view, offset) -> int:
+        """Do one READ (10) or WRITE (10) starting offset bytes into view with
+        transfer and return the number of bytes moved."""
+        size = min(len(view) - offset, _MAX_BYTES_PER_CBW)
+        data = view if size == len(view) else view[offset : offset + size]
+        count = size >> 9
+        # The count always fits in the low byte because it is capped at 128.
+        if cbw[23] != count:
+            struct.pack_into("<I", cbw, 8, size)
+            cbw[23] = count
+        struct.pack_into(">I", cbw, 17, block_num)
+        transfer(cbw, data)
+        return size
 
     def ioctl(self, operation: int, arg: Optional[int] = None) -> Optional[int]:
         """Perform an IOCTL operation"""